@@ -7,18 +7,247 @@ import os
 import sys
 import yaml
 import subprocess
+import re
+import bisect
+import queue
 import time
+import math
+import tempfile
 import logging
 from datetime import datetime, timedelta
 from pathlib import Path
 import cv2
 import numpy as np
-from threading import Thread, Lock
+try:
+    from numba import njit
+except ImportError:  # numba is optional, motion detection falls back to OpenCV
+    njit = None
+from threading import Thread, Lock, Condition
+from collections import deque, namedtuple
 import argparse
+import glob
+from concurrent.futures import ThreadPoolExecutor
 
 # Logger will be configured after loading config
 logger = logging.getLogger(__name__)
 
+# Fixed (width, height) frames are downscaled to before motion detection
+MOTION_FRAME_SIZE = (320, 240)
+
+# JPEG decode flags per reduction factor; reduced decoding skips most of the IDCT work
+REDUCED_GRAYSCALE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+}
+
+# Number of frames decoded and compared at once when filtering frames for a video
+MOTION_BATCH_SIZE = 16
+
+# Structuring element of the morphological opening that removes speckle from threshold images
+SPECKLE_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+
+
+if njit is not None:
+    # SWAR constants: four 16-bit lanes per 64-bit word, each holding one pixel
+    _LANE_LOW = np.uint64(0x00FF00FF00FF00FF)
+    _LANE_BIAS = np.uint64(0x4000400040004000)
+    _LANE_ONES = np.uint64(0x0001000100010001)
+    
+    @njit(cache=True)
+    def _word_motion_count(a_word, b_word, mask_word, offset):
+        """Count the pixels of one 64-bit word (8 pixels) inside mask whose difference is above the threshold
+        
+        Even and odd bytes are spread into 16-bit lanes, biased so that a - b and b - a can't
+        borrow across lanes, and the comparison with the threshold lands in bit 15 of each lane.
+        """
+        total = np.uint64(0)
+        for shift in (np.uint64(0), np.uint64(8)):
+            a_lanes = (a_word >> shift) & _LANE_LOW
+            b_lanes = (b_word >> shift) & _LANE_LOW
+            mask_lanes = (mask_word >> shift) & _LANE_LOW
+            above = ((a_lanes | _LANE_BIAS) - b_lanes + offset) | ((b_lanes | _LANE_BIAS) - a_lanes + offset)
+            hits = (above >> np.uint64(15)) & mask_lanes & _LANE_ONES
+            # Multiplying by the lane ones sums the four lanes into the top lane
+            total += (hits * _LANE_ONES) >> np.uint64(48)
+        return total
+    
+    def make_motion_counter(thr, mask):
+        """Compile a count(prev, cur) kernel for one camera's threshold and mask
+        
+        Counts the pixels inside mask whose difference exceeds thr (0-255) in a single pass over
+        8 pixels per 64-bit word; frames must be contiguous with a multiple of 8 pixels per row.
+        The threshold offset, the mask and the bounding box of its checked pixels are closure
+        constants, so numba folds them into the kernel: words outside the box are never read,
+        and a mask checking every pixel drops out of the loop entirely.
+        """
+        height, width = mask.shape
+        words_per_row = width // 8
+        rows = np.flatnonzero(mask.any(axis=1))
+        columns = np.flatnonzero(mask.any(axis=0))
+        if len(rows) == 0:
+            row_start = row_end = word_start = word_end = 0
+        else:
+            row_start, row_end = int(rows[0]), int(rows[-1]) + 1
+            word_start, word_end = int(columns[0]) // 8, int(columns[-1]) // 8 + 1
+        full_mask = bool(mask.all())
+        mask_words = mask.reshape(-1).view(np.uint64).copy()
+        # Bias plus this offset carries into bit 15 exactly when the difference is above thr
+        offset = np.uint64(0x3FFF - thr) * _LANE_ONES
+        all_lanes = ~np.uint64(0)
+        
+        @njit
+        def count(prev, cur):
+            a = prev.reshape(-1).view(np.uint64)
+            b = cur.reshape(-1).view(np.uint64)
+            total = np.uint64(0)
+            for row in range(row_start, row_end):
+                for i in range(row * words_per_row + word_start, row * words_per_row + word_end):
+                    total += _word_motion_count(a[i], b[i], all_lanes if full_mask else mask_words[i], offset)
+            return total
+        
+        return count
+else:
+    make_motion_counter = None
+
+
+def _opencv_has_simd():
+    """Whether OpenCV's pixel loops run vectorized on this CPU
+    
+    cv2.useOptimized() alone is only a runtime switch and defaults to True on every build, so
+    this also checks the build's SIMD baseline, the instruction sets every kernel is compiled
+    for (e.g. SSE2 on x86-64, NEON on ARM). OpenCV refuses to load on a CPU missing them, so a
+    non-empty baseline means SIMD is in use. Builds without a baseline (CPU_BASELINE= or an
+    unknown architecture) run plain C++ loops.
+    """
+    if not cv2.useOptimized():
+        return False
+    match = re.search(r'^\s*Baseline:[ \t]*(.*)$', cv2.getBuildInformation(), re.MULTILINE)
+    if match is None:
+        return True  # No CPU section in the build information, assume the usual SIMD build
+    return bool(match.group(1).split())
+
+
+# ffmpeg arguments per video encoder: global options, extra filters and output options.
+# With hw_encoder 'auto', the first hardware encoder ffmpeg supports is used, libx264 otherwise.
+# Hardware encoders negotiate their own input pixel format, only libx264 needs yuv420p forced.
+VIDEO_ENCODERS = {
+    'h264_nvenc': {
+        'global': [],
+        'filter': '',
+        'output': ['-c:v', 'h264_nvenc', '-preset', 'p4', '-rc', 'vbr', '-cq', '23'],
+    },
+    'h264_qsv': {
+        'global': [],
+        'filter': '',
+        'output': ['-c:v', 'h264_qsv', '-global_quality', '23'],
+    },
+    'h264_vaapi': {
+        'global': ['-vaapi_device', '/dev/dri/renderD128'],
+        'filter': ',format=nv12,hwupload',
+        'output': ['-c:v', 'h264_vaapi', '-qp', '23'],
+    },
+    'libx264': {
+        'global': [],
+        'filter': '',
+        # Timelapse frames are seen for a fraction of a second, veryfast is plenty
+        'output': ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p'],
+    },
+}
+
+# A frame kept in memory (frame_storage: memory): its would-be file name and JPEG bytes
+MemoryFrame = namedtuple('MemoryFrame', ['name', 'data'])
+
+
+class _CameraReader:
+    """Long-lived ffmpeg process decoding a camera stream, keeping the latest frame in memory
+    
+    A background thread reads raw BGR frames from the ffmpeg pipe as they arrive and only keeps
+    the most recent one, so no backlog builds up and captures don't wait for the stream.
+    """
+    
+    def __init__(self, cam_id, rtsp_url, size, fps):
+        self.cam_id = cam_id
+        self.size = size
+        
+        cmd = [
+            'ffmpeg',
+            '-nostdin',
+            '-loglevel', 'error',
+            '-rtsp_transport', 'tcp',  # Use TCP for more reliable streaming
+            '-fflags', 'nobuffer',  # Don't buffer input, the latest frame is all that matters
+            '-flags', 'low_delay',
+            '-i', rtsp_url,
+            '-an',  # Audio is never used
+            # Scale to the probed size, so a resolution change mid-stream can't misalign the raw frames
+            '-vf', f"fps={fps},scale={size[0]}:{size[1]}",
+            '-f', 'rawvideo',
+            '-pix_fmt', 'bgr24',
+            '-'
+        ]
+        # stderr is not read while the process runs, so don't let it fill a pipe
+        self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+        
+        self._cond = Condition()
+        self._latest = None
+        self._sequence = 0  # Number of frames received
+        self._returned = 0  # Sequence number of the last frame handed out
+        self._running = True
+        self._thread = Thread(target=self._run, name=f"reader-{cam_id}", daemon=True)
+        self._thread.start()
+    
+    def _run(self):
+        """Read frames until the stream ends, replacing the latest frame with each new one"""
+        width, height = self.size
+        frame_size = width * height * 3
+        try:
+            while True:
+                # A new buffer per frame, frames handed out are never overwritten
+                buf = bytearray(frame_size)
+                view = memoryview(buf)
+                received = 0
+                while received < frame_size:
+                    count = self._proc.stdout.readinto(view[received:])
+                    if not count:
+                        return
+                    received += count
+                
+                with self._cond:
+                    self._latest = np.frombuffer(buf, np.uint8).reshape(height, width, 3)
+                    self._sequence += 1
+                    self._cond.notify_all()
+        except Exception as e:
+            logger.debug(f"Reader thread for {self.cam_id} failed: {e}")
+        finally:
+            with self._cond:
+                self._running = False
+                self._cond.notify_all()
+    
+    def is_alive(self):
+        """Whether the ffmpeg process and its reader thread are still running"""
+        return self._running and self._proc.poll() is None
+    
+    def read(self, timeout):
+        """Return the latest frame not handed out yet, waiting up to timeout seconds for one
+        
+        Returns None on timeout or if the stream ended.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._sequence > self._returned or not self._running, timeout)
+            if self._sequence == self._returned:
+                return None
+            self._returned = self._sequence
+            return self._latest
+    
+    def stop(self):
+        """Terminate the ffmpeg process, which also ends the reader thread"""
+        try:
+            self._proc.kill()
+            self._proc.wait(timeout=5)
+        except Exception as e:
+            logger.debug(f"Error stopping reader for {self.cam_id}: {e}")
+        self._thread.join(timeout=5)
+
 
 class CCTVSummarizer:
     def __init__(self, config_path='config.yaml'):
@@ -45,10 +274,16 @@ class CCTVSummarizer:
         self.output_path = Path(self.settings.get('output_path', './output'))
         self.frames_path = self.output_path / 'frames'
         self.videos_path = self.output_path / 'videos'
+        self.state_path = self.output_path / 'state'
+        
+        # Per-camera frame and video directories, joined once instead of on every capture and generation
+        self._frames_dirs = {cam_id: self.frames_path / cam_id for cam_id in self.cameras}
+        self._videos_dirs = {cam_id: self.videos_path / cam_id for cam_id in self.cameras}
         
         # iframe template settings
         self.iframe_template_path = self.settings.get('iframe_template')
         self.iframe_template = None
+        self.iframe_template_str = None  # Template as a format string with a {video_path} field
         if self.iframe_template_path:
             self._load_iframe_template()
         
@@ -58,6 +293,16 @@ class CCTVSummarizer:
         if self.history_template_path:
             self._load_history_template()
         
+        # Video encoder: 'auto' picks a hardware encoder if available, or name one from VIDEO_ENCODERS
+        self.hw_encoder = self.settings.get('hw_encoder', 'auto')
+        self._video_encoder = None  # Resolved on first video generation
+        
+        # Video output settings, read once instead of on every generation
+        self.video_format = self.settings.get('video_format', 'mp4')
+        self.video_fps = self.settings.get('video_fps', 25)
+        self._video_scale = str(self.settings.get('resolution', '720p')).rstrip('p')
+        self._encode_cmd_parts = {}  # Per encoder: ffmpeg arguments before and after the input arguments
+        
         # Option to create latest.mp4 symlink (disabled by default due to caching issues)
         self.create_latest_link = self.settings.get('create_latest_link', False)
         
@@ -68,11 +313,118 @@ class CCTVSummarizer:
         self.default_min_motion_area = self.settings.get('min_motion_area', 500)  # Minimum area to consider as motion
         self.default_blur_kernel = self.settings.get('blur_kernel', 5)  # Gaussian blur kernel size (0 to disable)
         self.default_average_filter = self.settings.get('average_filter', 1)  # Number of frames to average (1 = no averaging)
+        self.default_filter_on_capture = self.settings.get('filter_on_capture', False)  # Discard frames without motion at capture time
+        self.default_three_frame_diff = self.settings.get('three_frame_diff', False)  # Require motion across three consecutive frames
+        self.default_despeckle = self.settings.get('despeckle', False)  # Remove isolated changed pixels before the region check
+        
+        # Frames captured further apart than motion_max_interval differ by lighting and weather anyway,
+        # so track_changes would keep nearly all of them; skip motion detection entirely then (off by default)
+        motion_max_interval = self.settings.get('motion_max_interval')
+        self._motion_enabled = (motion_max_interval is None
+                                or self.capture_interval <= self._parse_duration(motion_max_interval))
+        if not self._motion_enabled:
+            logger.info(f"capture_interval is above motion_max_interval ({motion_max_interval}), "
+                        f"motion detection is disabled and all frames are kept")
+        
+        # JPEG encoding parameters of captured frames per camera, baseline without the optimize pass;
+        # frames only feed a re-encoded timelapse, so quality 75 is enough at about a quarter of the size of 95
+        default_jpeg_quality = self.settings.get('jpeg_quality', 75)
+        self._jpeg_params = {
+            cam_id: [cv2.IMWRITE_JPEG_QUALITY, int(camera_config.get('jpeg_quality', default_jpeg_quality)),
+                     cv2.IMWRITE_JPEG_OPTIMIZE, 0, cv2.IMWRITE_JPEG_PROGRESSIVE, 0]
+            for cam_id, camera_config in self.cameras.items()
+        }
         
         # Store previous frames for motion detection
         self.previous_frames = {}
+        self.prev_prev_frames = {}  # Frame before the previous one, for three-frame differencing
         self.frame_locks = {cam_id: Lock() for cam_id in self.cameras.keys()}
         
+        # Reference frames of cameras filtered on capture are memory-mapped into state_path
+        # while the capture loop runs, so they survive restarts
+        self._persist_motion_state = False
+        
+        # Reusable per-camera output buffers for the difference and threshold images
+        self._diff_buf = {}
+        self._thresh_buf = {}
+        self._diff2_buf = {}
+        self._thresh2_buf = {}
+        
+        # Per-camera JPEG decode reduction factor, picked once the frame size is known
+        self._decode_reduction = {}
+        
+        # Sorted deques of (filename, absolute path) of each camera's frames on disk, scanned once
+        # and then kept up to date by captures and cleanups instead of listing the directory again
+        self._frame_index = {}
+        self._frame_index_lock = Lock()
+        
+        # Where captured frames are kept: 'disk' (JPEG files in frames_path) or 'memory' (JPEG bytes in a
+        # per-camera ring holding one summary_duration of frames, piped straight to the encoder; lost on restart)
+        self.frame_storage = self.settings.get('frame_storage', 'disk')
+        self._memory_frames = {}
+        self._memory_frames_max = max(2, math.ceil(self.summary_duration / self.capture_interval))
+        
+        # Ring of the last captured frames per camera, already prepared for motion detection, so
+        # filtering them for a video doesn't decode the JPEGs again. One contiguous array per
+        # camera, slots are reused oldest first; the index maps file names to (slot, source size)
+        self.motion_cache_frames = self.settings.get('motion_cache_frames', 0)
+        self._motion_ring = {}
+        self._motion_ring_index = {}
+        self._motion_ring_lock = Lock()
+        
+        # Per-camera pixel masks from the motion_mask setting (255 = pixel is checked for motion,
+        # 0 = ignored); cameras without a mask check every pixel
+        self._motion_masks = {}
+        self._full_mask = np.full((MOTION_FRAME_SIZE[1], MOTION_FRAME_SIZE[0]), 255, np.uint8)
+        self._load_motion_masks()
+        
+        # Pixel counting backend: 'opencv' (default), 'numba' (single-pass SWAR kernel),
+        # 'opencl' (counted on the GPU through OpenCV's transparent API) or 'cuda' (OpenCV's CUDA module).
+        # 'auto' uses numba only when OpenCV's build or settings leave its pixel loops unvectorized
+        self.motion_backend = self.settings.get('motion_backend', 'opencv')
+        if self.motion_backend == 'auto':
+            self.motion_backend = 'numba' if make_motion_counter is not None and not _opencv_has_simd() else 'opencv'
+            logger.info(f"Using motion backend: {self.motion_backend}")
+        elif self.motion_backend == 'numba' and make_motion_counter is None:
+            logger.warning("motion_backend 'numba' requested but numba is not installed, using opencv")
+            self.motion_backend = 'opencv'
+        elif self.motion_backend == 'opencl' and not cv2.ocl.haveOpenCL():
+            logger.warning("motion_backend 'opencl' requested but no OpenCL device is available, using opencv")
+            self.motion_backend = 'opencv'
+        elif self.motion_backend == 'cuda' and not (hasattr(cv2, 'cuda') and cv2.cuda.getCudaEnabledDeviceCount() > 0):
+            logger.warning("motion_backend 'cuda' requested but OpenCV has no CUDA device available, using opencv")
+            self.motion_backend = 'opencv'
+        if self.motion_backend == 'opencl':
+            cv2.ocl.setUseOpenCL(True)
+        
+        # Per-camera numba counters specialized for the camera's threshold and mask, compiled on first use
+        self._motion_fn = {}
+        
+        # Device copies of the reference frames for the opencl and cuda backends, and the last uploaded
+        # frame of each camera, which becomes the reference when the host reference is updated
+        self._device_prev = {}
+        self._device_current = {}
+        self._device_masks = {}
+        
+        # Keep one long-lived ffmpeg reader per camera instead of reconnecting on every capture
+        self.persistent_capture = self.settings.get('persistent_capture', True)
+        self._readers = {}
+        
+        # Capture cameras in parallel, so a slow camera doesn't delay the others
+        self._pool = ThreadPoolExecutor(max_workers=max(1, len(self.cameras)))
+        
+        # Video generation runs in its own bounded pool: ffmpeg encodes are multi-threaded already,
+        # so more concurrent encodes than half the cores only makes them compete
+        self._video_pool = ThreadPoolExecutor(
+            max_workers=max(1, min(len(self.cameras), (os.cpu_count() or 2) // 2)),
+            thread_name_prefix='video'
+        )
+        
+        # While the capture loop runs, captured frames are handed to a writer thread through this
+        # bounded queue, so JPEG encoding and disk writes overlap with the next reads and motion checks
+        self._write_queue = None
+        self._writer = None
+        
     def _load_config(self, config_path):
         """Load YAML configuration file"""
         try:
@@ -118,12 +470,43 @@ class CCTVSummarizer:
             if template_path.exists():
                 with open(template_path, 'r') as f:
                     self.iframe_template = f.read()
+                
+                # Normalize both placeholder formats to a single format field once, so every
+                # generated page is one format_map pass; other braces are escaped literally
+                parts = re.split(r'\{\{video_path\}\}|\$RELPATH', self.iframe_template)
+                self.iframe_template_str = '{video_path}'.join(
+                    part.replace('{', '{{').replace('}', '}}') for part in parts)
                 logger.info(f"Loaded iframe template from {template_path}")
             else:
                 logger.warning(f"Iframe template file not found: {template_path}")
         except Exception as e:
             logger.error(f"Failed to load iframe template: {e}")
     
+    def _load_motion_masks(self):
+        """Load the motion mask images of cameras that configure one, downscaled to the motion frame size"""
+        for cam_id, camera_config in self.cameras.items():
+            mask_path = camera_config.get('motion_mask')
+            if not mask_path:
+                continue
+            
+            try:
+                mask_path = Path(mask_path)
+                if not mask_path.is_absolute():
+                    # Make path relative to script directory
+                    mask_path = Path(__file__).parent / mask_path
+                
+                mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
+                if mask is None:
+                    logger.warning(f"Motion mask for {cam_id} not found or unreadable: {mask_path}")
+                    continue
+                
+                # White areas are checked for motion, black areas are ignored
+                mask = cv2.resize(mask, MOTION_FRAME_SIZE, interpolation=cv2.INTER_AREA)
+                self._motion_masks[cam_id] = np.where(mask > 127, 255, 0).astype(np.uint8)
+                logger.info(f"Loaded motion mask for {cam_id} from {mask_path}")
+            except Exception as e:
+                logger.error(f"Failed to load motion mask for {cam_id}: {e}")
+    
     def _load_history_template(self):
         """Load history template file if specified"""
         try:
@@ -161,84 +544,144 @@ class CCTVSummarizer:
         self.output_path.mkdir(parents=True, exist_ok=True)
         self.frames_path.mkdir(exist_ok=True)
         self.videos_path.mkdir(exist_ok=True)
+        self.state_path.mkdir(exist_ok=True)
         
         for cam_id in self.cameras.keys():
-            (self.frames_path / cam_id).mkdir(exist_ok=True)
-            (self.videos_path / cam_id).mkdir(exist_ok=True)
+            self._frames_dirs[cam_id].mkdir(exist_ok=True)
+            self._videos_dirs[cam_id].mkdir(exist_ok=True)
     
     def capture_frame(self, cam_id, camera_config):
         """Capture a single frame from a camera using ffmpeg
         
-        If average_filter > 1, captures multiple frames and averages them to reduce temporal noise
+        If average_filter > 1, captures multiple frames and averages them to reduce temporal noise.
+        If filter_on_capture is enabled, frames without motion are discarded before being written.
         """
         timestamp = datetime.now()
         filename = timestamp.strftime('%Y%m%d_%H%M%S.jpg')
-        output_file = self.frames_path / cam_id / filename
+        output_file = self._frames_dirs[cam_id] / filename
         
         rtsp_url = camera_config['url']
         
         # Get average_filter setting (camera-specific or default)
         average_filter = camera_config.get('average_filter', self.default_average_filter)
         
-        # If average_filter is 1, use the original single-frame capture
+        # If average_filter is 1, take a single frame
         if average_filter <= 1:
-            return self._capture_single_frame(cam_id, rtsp_url, output_file)
-        
-        # If average_filter > 1, capture multiple frames and average them
-        logger.debug(f"Capturing {average_filter} frames from {cam_id} for averaging")
-        
-        frames = []
-        for i in range(average_filter):
-            # Capture frame to temporary location
-            temp_file = self.frames_path / cam_id / f"temp_{timestamp.strftime('%Y%m%d_%H%M%S')}_{i}.jpg"
-            
-            result_file = self._capture_single_frame(cam_id, rtsp_url, temp_file)
+            frame = self._grab_frame(cam_id, rtsp_url)
+            if frame is None:
+                return None
+        else:
+            # If average_filter > 1, capture multiple frames and average them
+            logger.debug(f"Capturing {average_filter} frames from {cam_id} for averaging")
             
-            if result_file and result_file.exists():
-                # Read the frame
-                frame = cv2.imread(str(result_file))
+            frames = []
+            for i in range(average_filter):
+                frame = self._grab_frame(cam_id, rtsp_url)
                 if frame is not None:
                     frames.append(frame)
-                # Delete temporary file
-                try:
-                    result_file.unlink()
-                except Exception as e:
-                    logger.warning(f"Failed to delete temp file {result_file}: {e}")
+                else:
+                    logger.warning(f"Failed to capture frame {i+1}/{average_filter} from {cam_id}")
+            
+            # If we didn't get any frames, return None
+            if not frames:
+                logger.error(f"No frames captured from {cam_id} for averaging")
+                return None
+            
+            # If we only got one frame, save it directly
+            if len(frames) == 1:
+                frame = frames[0]
+                logger.debug(f"Only 1 frame captured from {cam_id}, saved without averaging")
             else:
-                logger.warning(f"Failed to capture frame {i+1}/{average_filter} from {cam_id}")
+                # Average the frames
+                logger.debug(f"Averaging {len(frames)} frames from {cam_id}")
+                frame = np.mean(frames, axis=0).astype(np.uint8)
         
-        # If we didn't get any frames, return None
-        if not frames:
-            logger.error(f"No frames captured from {cam_id} for averaging")
+        # Run motion detection on the in-memory frame, only frames with motion reach the disk
+        if self._filters_on_capture(cam_id) and not self._has_motion(cam_id, frame):
+            logger.debug(f"No motion in frame from {cam_id}, discarded {filename}")
             return None
         
-        # If we only got one frame, save it directly
-        if len(frames) == 1:
-            cv2.imwrite(str(output_file), frames[0])
-            logger.debug(f"Only 1 frame captured from {cam_id}, saved without averaging")
-            return output_file
+        if self._write_queue is not None:
+            # Blocks while the writer is behind, which holds this camera's next capture back
+            self._write_queue.put((cam_id, camera_config, filename, output_file, frame))
+        else:
+            self._write_frame(cam_id, camera_config, filename, output_file, frame)
         
-        # Average the frames
-        logger.debug(f"Averaging {len(frames)} frames from {cam_id}")
-        averaged_frame = np.mean(frames, axis=0).astype(np.uint8)
+        return output_file
+    
+    def _write_frame(self, cam_id, camera_config, filename, output_file, frame):
+        """Encode and write a captured frame, then record it in the frame index"""
+        ok, encoded = cv2.imencode('.jpg', frame, self._jpeg_params[cam_id])
+        if not ok:
+            logger.warning(f"Failed to encode frame from {cam_id}")
+            return
+        stored_frame = MemoryFrame(filename, encoded.tobytes())
         
-        # Save the averaged frame
-        cv2.imwrite(str(output_file), averaged_frame)
-        logger.debug(f"Captured and averaged frame from {cam_id}: {filename}")
+        if self.frame_storage == 'memory':
+            with self._frame_index_lock:
+                self._stored_memory_frames(cam_id).append(stored_frame)
+        else:
+            with open(output_file, 'wb') as f:
+                f.write(stored_frame.data)
+            self._add_to_frame_index(cam_id, filename, output_file)
+        logger.debug(f"Captured frame from {cam_id}: {filename}")
         
-        return output_file
+        # Frames filtered at video generation are prepared now, from the same JPEG bytes a
+        # later decode would read, so cached and uncached frames get the same decision
+        if self.motion_cache_frames > 0 and self._tracks_changes(cam_id) and not self._filters_on_capture(cam_id):
+            self._cache_motion_frame(cam_id, stored_frame)
+    
+    def _writer_loop(self):
+        """Write queued frames until a None sentinel arrives (runs in the writer thread)"""
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                return
+            try:
+                self._write_frame(*item)
+            except Exception as e:
+                logger.error(f"Error writing frame from {item[0]}: {e}")
+    
+    def _start_writer(self):
+        """Start the writer thread captured frames are queued to"""
+        self._write_queue = queue.Queue(maxsize=2 * max(1, len(self.cameras)))
+        self._writer = Thread(target=self._writer_loop, name='frame-writer', daemon=True)
+        self._writer.start()
     
-    def _capture_single_frame(self, cam_id, rtsp_url, output_file):
-        """Internal method to capture a single frame using ffmpeg"""
-        # Use ffmpeg to capture a single frame
+    def _stop_writer(self):
+        """Write the frames still queued and stop the writer thread"""
+        if self._writer is None:
+            return
+        self._write_queue.put(None)
+        self._writer.join(timeout=30)
+        self._write_queue = None
+        self._writer = None
+    
+    def _grab_frame(self, cam_id, rtsp_url):
+        """Get the next frame from the persistent reader, or from a single capture if it's disabled or fails"""
+        if self.persistent_capture:
+            frame = self._read_frame(cam_id, rtsp_url)
+            if frame is not None:
+                return frame
+            logger.debug(f"Persistent reader unavailable for {cam_id}, falling back to single capture")
+        return self._capture_single_frame(cam_id, rtsp_url)
+    
+    def _capture_single_frame(self, cam_id, rtsp_url):
+        """Internal method to capture a single frame into memory using ffmpeg
+        
+        Returns the decoded BGR frame, or None on failure.
+        """
+        # Use ffmpeg to capture a single frame, piped as JPEG to stdout
         cmd = [
             'ffmpeg',
-            '-y',  # Overwrite output file
+            '-loglevel', 'error',  # stderr only carries errors, read when the capture fails
             '-rtsp_transport', 'tcp',  # Use TCP for more reliable streaming
             '-i', rtsp_url,
             '-frames:v', '1',  # Capture only 1 frame
             '-q:v', '2',  # Quality (2-5 is good)
-            str(output_file)
+            '-f', 'image2pipe',
+            '-vcodec', 'mjpeg',
+            '-'
         ]
         
         try:
@@ -249,8 +692,11 @@ class CCTVSummarizer:
                 timeout=10
             )
             
-            if result.returncode == 0 and output_file.exists():
-                return output_file
+            if result.returncode == 0 and result.stdout:
+                frame = cv2.imdecode(np.frombuffer(result.stdout, np.uint8), cv2.IMREAD_COLOR)
+                if frame is None:
+                    logger.warning(f"Failed to decode frame from {cam_id}")
+                return frame
             else:
                 logger.warning(f"Failed to capture from {cam_id}: {result.stderr.decode()}")
                 return None
@@ -262,86 +708,531 @@ class CCTVSummarizer:
             logger.error(f"Error capturing frame from {cam_id}: {e}")
             return None
     
-    def _has_motion(self, cam_id, frame_path, debug=False, save_debug_images=False):
+    def _probe_stream_size(self, cam_id, rtsp_url):
+        """Probe the (width, height) of a camera's video stream using ffprobe"""
+        cmd = [
+            'ffprobe',
+            '-v', 'error',
+            '-rtsp_transport', 'tcp',
+            '-select_streams', 'v:0',
+            '-show_entries', 'stream=width,height',
+            '-of', 'csv=p=0:s=x',
+            rtsp_url
+        ]
+        
+        try:
+            result = subprocess.run(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=10
+            )
+            
+            if result.returncode == 0:
+                width, height = result.stdout.decode().strip().splitlines()[0].split('x')
+                return int(width), int(height)
+            else:
+                logger.warning(f"Failed to probe stream size for {cam_id}: {result.stderr.decode()}")
+                return None
+                
+        except subprocess.TimeoutExpired:
+            logger.error(f"Timeout probing stream size for {cam_id}")
+            return None
+        except Exception as e:
+            logger.error(f"Error probing stream size for {cam_id}: {e}")
+            return None
+    
+    def _start_reader(self, cam_id, rtsp_url):
+        """Start the long-lived reader of a camera"""
+        # Probed on every start, a camera coming back from a reboot or profile change may have a new size
+        size = self._probe_stream_size(cam_id, rtsp_url)
+        if size is None:
+            return None
+        
+        # At least one frame per second, so the latest frame is never much older than the capture
+        fps = max(1.0, 1.0 / self.capture_interval)
+        
+        try:
+            reader = _CameraReader(cam_id, rtsp_url, size, fps)
+        except Exception as e:
+            logger.error(f"Error starting reader for {cam_id}: {e}")
+            return None
+        
+        self._readers[cam_id] = reader
+        logger.info(f"Started persistent reader for {cam_id} ({size[0]}x{size[1]})")
+        return reader
+    
+    def _stop_reader(self, cam_id):
+        """Terminate the persistent reader of a camera, if running"""
+        reader = self._readers.pop(cam_id, None)
+        if reader is not None:
+            reader.stop()
+    
+    def stop_readers(self):
+        """Terminate all persistent readers"""
+        for cam_id in list(self._readers.keys()):
+            self._stop_reader(cam_id)
+    
+    def _read_frame(self, cam_id, rtsp_url):
+        """Take the latest frame from the camera's persistent reader as a BGR ndarray
+        
+        Each call returns a frame not returned before. Restarts the reader if it has died,
+        returns None if no frame could be read.
+        """
+        reader = self._readers.get(cam_id)
+        
+        # Watchdog: restart readers that exited (camera reboot, network drop, ...)
+        if reader is not None and not reader.is_alive():
+            logger.warning(f"Reader for {cam_id} exited, restarting")
+            self._stop_reader(cam_id)
+            reader = None
+        
+        if reader is None:
+            reader = self._start_reader(cam_id, rtsp_url)
+            if reader is None:
+                return None
+        
+        # Frames arrive at least every second once connected, allow for connection slack
+        frame = reader.read(timeout=15)
+        if frame is None:
+            logger.error(f"No frame from the reader of {cam_id} (timeout or stream ended), restarting reader")
+            self._stop_reader(cam_id)
+        return frame
+    
+    def _prepare_motion_frame(self, cam_id, frame, use_cache=True):
+        """Turn a frame into the downscaled, blurred grayscale image motion detection works on
+        
+        Args:
+            cam_id: Camera identifier
+            frame: Path to the frame, a MemoryFrame, or the already decoded BGR/grayscale frame
+            use_cache: Look the frame up in the camera's motion frame ring before decoding it
+        
+        Returns:
+            (motion_frame, (source_width, source_height)), or (None, None) if the frame can't be read
+        """
+        if isinstance(frame, np.ndarray):
+            # In-memory frame, no disk round-trip needed
+            current_frame = frame
+            source_height, source_width = current_frame.shape[:2]
+        else:
+            is_memory_frame = isinstance(frame, MemoryFrame)
+            if use_cache:
+                cached = self._cached_motion_frame(cam_id, frame.name if is_memory_frame else Path(frame).name)
+                if cached is not None:
+                    return cached
+            
+            # Decode at reduced resolution when the frame is still at least the motion frame size
+            reduction = self._decode_reduction.get(cam_id, 1)
+            flags = REDUCED_GRAYSCALE_FLAGS.get(reduction, cv2.IMREAD_GRAYSCALE)
+            if is_memory_frame:
+                current_frame = cv2.imdecode(np.frombuffer(frame.data, np.uint8), flags)
+            else:
+                current_frame = cv2.imread(str(frame), flags)
+            if current_frame is None:
+                return None, None
+            
+            source_height, source_width = current_frame.shape[0] * reduction, current_frame.shape[1] * reduction
+            if cam_id not in self._decode_reduction:
+                self._decode_reduction[cam_id] = next(
+                    (factor for factor in REDUCED_GRAYSCALE_FLAGS
+                     if source_width // factor >= MOTION_FRAME_SIZE[0] and source_height // factor >= MOTION_FRAME_SIZE[1]),
+                    1
+                )
+        
+        # Downscale to a fixed size - motion gating doesn't need full resolution
+        current_frame = cv2.resize(current_frame, MOTION_FRAME_SIZE, interpolation=cv2.INTER_AREA)
+        if current_frame.ndim == 3:
+            # Convert after downscaling, so only the small frame goes through cvtColor
+            current_frame = cv2.cvtColor(current_frame, cv2.COLOR_BGR2GRAY)
+        
+        # Apply Gaussian blur to reduce noise (if enabled), kernel is configured in source pixels
+        blur_kernel = self.cameras[cam_id].get('blur_kernel', self.default_blur_kernel)
+        kernel_size = int(round(blur_kernel * MOTION_FRAME_SIZE[0] / source_width))
+        if kernel_size > 1:
+            # Ensure kernel size is odd
+            kernel_size = kernel_size if kernel_size % 2 == 1 else kernel_size + 1
+            current_frame = cv2.GaussianBlur(current_frame, (kernel_size, kernel_size), 0)
+        
+        return current_frame, (source_width, source_height)
+    
+    def _cache_motion_frame(self, cam_id, frame):
+        """Prepare an encoded captured frame (MemoryFrame) for motion detection and keep it in the camera's ring"""
+        motion_frame, source_size = self._prepare_motion_frame(cam_id, frame, use_cache=False)
+        if motion_frame is None:
+            return
+        
+        with self._motion_ring_lock:
+            if cam_id not in self._motion_ring:
+                self._motion_ring[cam_id] = np.empty((self.motion_cache_frames, MOTION_FRAME_SIZE[1], MOTION_FRAME_SIZE[0]), np.uint8)
+                self._motion_ring_index[cam_id] = {}
+            index = self._motion_ring_index[cam_id]
+            
+            if frame.name in index:
+                # Same name again (clock went back, or two captures in one second): reuse its slot,
+                # the name then moves to the newest end of the eviction order
+                slot, _ = index.pop(frame.name)
+            elif len(index) < self.motion_cache_frames:
+                slot = len(index)
+            else:
+                # Evict the oldest frame, dicts keep insertion order
+                slot, _ = index.pop(next(iter(index)))
+            
+            self._motion_ring[cam_id][slot] = motion_frame
+            index[frame.name] = (slot, source_size)
+    
+    def _cached_motion_frame(self, cam_id, filename):
+        """Prepared motion frame of a file from the camera's ring, or None if it's not cached"""
+        with self._motion_ring_lock:
+            entry = self._motion_ring_index.get(cam_id, {}).get(filename)
+            if entry is None:
+                return None
+            slot, source_size = entry
+            # Copy out, the slot may be reused by the next capture
+            return self._motion_ring[cam_id][slot].copy(), source_size
+    
+    def _scaled_min_motion_area(self, cam_id, source_size):
+        """min_motion_area is configured in source pixels, scale it to the downscaled motion frame"""
+        min_motion_area = self.cameras[cam_id].get('min_motion_area', self.default_min_motion_area)
+        source_width, source_height = source_size
+        return min_motion_area * (MOTION_FRAME_SIZE[0] * MOTION_FRAME_SIZE[1]) / (source_width * source_height)
+    
+    @staticmethod
+    def _threshold_diff(frame, reference, motion_threshold, mask, diff_buf, thresh_buf):
+        """Threshold image of the pixels that changed between two motion frames, inside mask if given"""
+        cv2.absdiff(frame, reference, dst=diff_buf)
+        cv2.threshold(diff_buf, motion_threshold, 255, cv2.THRESH_BINARY, dst=thresh_buf)
+        if mask is not None:
+            cv2.bitwise_and(thresh_buf, mask, dst=thresh_buf)
+        return thresh_buf
+    
+    def _despeckle(self, cam_id, thresh):
+        """Remove isolated changed pixels and thin lines from a threshold image in place, if enabled"""
+        if self.cameras[cam_id].get('despeckle', self.default_despeckle):
+            cv2.morphologyEx(thresh, cv2.MORPH_OPEN, SPECKLE_KERNEL, dst=thresh)
+    
+    @staticmethod
+    def _largest_region_area(thresh):
+        """Area of the largest 8-connected region of changed pixels in a thresholded image"""
+        _, _, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8)
+        return stats[1:, cv2.CC_STAT_AREA].max() if len(stats) > 1 else 0
+    
+    def _filter_motion_frames(self, cam_id, frame_paths):
+        """Return the frames with motion, deciding exactly like _has_motion called on each frame in order
+        
+        Frames are decoded in batches, and the changed-pixel counts of a whole batch against the
+        reference frame are counted before any region check. Only frames whose count is large
+        enough can contain a large enough region, so only those go through the region check.
+        """
+        motion_threshold = self.cameras[cam_id].get('motion_threshold', self.default_motion_threshold)
+        mask = self._motion_masks.get(cam_id)
+        
+        # Difference and threshold images are rewritten for every frame compared
+        diff_buf = np.empty((MOTION_FRAME_SIZE[1], MOTION_FRAME_SIZE[0]), np.uint8)
+        thresh_buf = np.empty_like(diff_buf)
+        
+        kept = []
+        reference = None
+        for start in range(0, len(frame_paths), MOTION_BATCH_SIZE):
+            batch_paths = []
+            batch_frames = []
+            batch_areas = []
+            for frame_path in frame_paths[start:start + MOTION_BATCH_SIZE]:
+                # Check if frame still exists (might have been cleaned up)
+                if not self._frame_exists(frame_path):
+                    logger.debug(f"Frame {frame_path.name} no longer exists, skipping")
+                    continue
+                
+                motion_frame, source_size = self._prepare_motion_frame(cam_id, frame_path)
+                if motion_frame is None:
+                    kept.append(frame_path)  # Keep frame if we can't read it
+                    continue
+                
+                batch_paths.append(frame_path)
+                batch_frames.append(motion_frame)
+                batch_areas.append(self._scaled_min_motion_area(cam_id, source_size))
+            
+            if not batch_frames:
+                continue
+            
+            stack = np.stack(batch_frames)
+            areas = np.array(batch_areas)
+            
+            index = 0
+            if reference is None:
+                # If no previous frame, keep this one
+                reference = stack[0].copy()
+                kept.append(batch_paths[0])
+                index = 1
+            
+            while index < len(stack):
+                # Changed-pixel count of every remaining frame against the current reference
+                if self.motion_backend == 'numba':
+                    counter = self._motion_counter(cam_id)
+                    counts = np.array([counter(reference, frame) for frame in stack[index:]])
+                else:
+                    # OpenCV's absdiff and threshold frame by frame into reused buffers, much faster
+                    # than numpy's broadcasted passes over the whole stack and its temporaries
+                    counts = np.array([
+                        cv2.countNonZero(self._threshold_diff(frame, reference, motion_threshold, mask, diff_buf, thresh_buf))
+                        for frame in stack[index:]
+                    ])
+                
+                # The reference only changes on motion, so counts stay valid until a frame is kept
+                motion_index = None
+                for candidate in np.flatnonzero(counts > areas[index:]):
+                    frame_index = index + candidate
+                    thresh = self._threshold_diff(stack[frame_index], reference, motion_threshold, mask, diff_buf, thresh_buf)
+                    self._despeckle(cam_id, thresh)
+                    if self._largest_region_area(thresh) > areas[frame_index]:
+                        motion_index = frame_index
+                        break
+                
+                if motion_index is None:
+                    break
+                
+                kept.append(batch_paths[motion_index])
+                np.copyto(reference, stack[motion_index])
+                index = motion_index + 1
+        
+        return sorted(kept)
+    
+    def _tracks_changes(self, cam_id):
+        """Whether frames of a camera are filtered by motion, at capture or at video generation"""
+        return self._motion_enabled and self.cameras[cam_id].get('track_changes', False)
+    
+    def _filters_on_capture(self, cam_id):
+        """Whether frames of a camera are filtered by motion at capture time"""
+        return (self._tracks_changes(cam_id)
+                and self.cameras[cam_id].get('filter_on_capture', self.default_filter_on_capture))
+    
+    def _state_file(self, cam_id, name):
+        """Path of a persisted motion reference buffer"""
+        return self.state_path / f"{cam_id}_{name}.npy"
+    
+    def _reference_buffer(self, cam_id, name, frame):
+        """Copy frame into a new reference buffer of a camera
+        
+        Buffers of cameras filtered on capture are memory-mapped .npy files while the capture
+        loop runs; updates then go through np.copyto and the OS flushes them lazily.
+        """
+        if self._persist_motion_state and self._filters_on_capture(cam_id):
+            try:
+                buffer = np.lib.format.open_memmap(self._state_file(cam_id, name), mode='w+',
+                                                   dtype=np.uint8, shape=frame.shape)
+                np.copyto(buffer, frame)
+                return buffer
+            except Exception as e:
+                logger.warning(f"Failed to persist motion state for {cam_id}: {e}")
+        
+        return frame.copy()
+    
+    def _load_motion_state(self):
+        """Enable persisted reference frames and load the ones left by a previous run"""
+        self._persist_motion_state = True
+        
+        for cam_id in self.cameras:
+            if not self._filters_on_capture(cam_id):
+                continue
+            
+            for name, references in (('prev', self.previous_frames), ('prev2', self.prev_prev_frames)):
+                state_file = self._state_file(cam_id, name)
+                if not state_file.exists():
+                    continue
+                try:
+                    buffer = np.load(state_file, mmap_mode='r+')
+                    if buffer.dtype == np.uint8 and buffer.shape == (MOTION_FRAME_SIZE[1], MOTION_FRAME_SIZE[0]):
+                        references[cam_id] = buffer
+                        logger.debug(f"Loaded motion state {state_file.name}")
+                    else:
+                        logger.warning(f"Ignoring motion state {state_file} with unexpected shape {buffer.shape}")
+                except Exception as e:
+                    logger.warning(f"Failed to load motion state {state_file}: {e}")
+    
+    def _motion_mask(self, cam_id):
+        """Pixel mask of the motion frame for a camera, all pixels are checked by default"""
+        return self._motion_masks.get(cam_id, self._full_mask)
+    
+    def _reset_motion_state(self, cam_id):
+        """Forget the reference frames of a camera, the next frame is always kept"""
+        with self.frame_locks[cam_id]:
+            self.previous_frames.pop(cam_id, None)
+            self.prev_prev_frames.pop(cam_id, None)
+            self._device_prev.pop(cam_id, None)
+            self._device_current.pop(cam_id, None)
+    
+    def _count_motion_pixels(self, cam_id, prev_frame, current_frame, motion_threshold):
+        """Count changed pixels against the camera's reference frame with the configured backend
+        
+        Returns None with the 'opencv' backend, which counts on the threshold image it builds anyway.
+        """
+        if self.motion_backend == 'numba':
+            return self._motion_counter(cam_id)(prev_frame, current_frame)
+        
+        if self.motion_backend == 'opencl':
+            # The reference stays on the device, only the new frame is uploaded; difference,
+            # threshold and count run back to back there and only the count comes back
+            prev_device = self._device_prev.get(cam_id)
+            if prev_device is None:
+                prev_device = self._device_prev[cam_id] = cv2.UMat(prev_frame)
+            current_device = self._device_current[cam_id] = cv2.UMat(current_frame)
+            _, thresh = cv2.threshold(cv2.absdiff(prev_device, current_device), motion_threshold, 255, cv2.THRESH_BINARY)
+            if cam_id in self._motion_masks:
+                if cam_id not in self._device_masks:
+                    self._device_masks[cam_id] = cv2.UMat(self._motion_masks[cam_id])
+                thresh = cv2.bitwise_and(thresh, self._device_masks[cam_id])
+            return cv2.countNonZero(thresh)
+        
+        if self.motion_backend == 'cuda':
+            # Same as opencl, with the reference kept in GPU memory as a GpuMat
+            prev_device = self._device_prev.get(cam_id)
+            if prev_device is None:
+                prev_device = self._device_prev[cam_id] = cv2.cuda_GpuMat()
+                prev_device.upload(prev_frame)
+            current_device = self._device_current[cam_id] = cv2.cuda_GpuMat()
+            current_device.upload(current_frame)
+            _, thresh = cv2.cuda.threshold(cv2.cuda.absdiff(prev_device, current_device), motion_threshold, 255, cv2.THRESH_BINARY)
+            if cam_id in self._motion_masks:
+                if cam_id not in self._device_masks:
+                    self._device_masks[cam_id] = cv2.cuda_GpuMat()
+                    self._device_masks[cam_id].upload(self._motion_masks[cam_id])
+                thresh = cv2.cuda.bitwise_and(thresh, self._device_masks[cam_id])
+            return cv2.cuda.countNonZero(thresh)
+        
+        return None
+    
+    def _motion_counter(self, cam_id):
+        """numba pixel counter specialized for a camera, compiled the first time it's needed"""
+        if cam_id not in self._motion_fn:
+            motion_threshold = self.cameras[cam_id].get('motion_threshold', self.default_motion_threshold)
+            self._motion_fn[cam_id] = make_motion_counter(motion_threshold, self._motion_mask(cam_id))
+        return self._motion_fn[cam_id]
+    
+    def _update_device_reference(self, cam_id):
+        """Make the last uploaded frame the device reference after the host reference was updated"""
+        if self.motion_backend not in ('opencl', 'cuda'):
+            return
+        current_device = self._device_current.pop(cam_id, None)
+        if current_device is None:
+            # Frame was never uploaded (debug run), upload the new reference on next use
+            self._device_prev.pop(cam_id, None)
+        else:
+            self._device_prev[cam_id] = current_device
+    
+    def _has_motion(self, cam_id, frame, debug=False, save_debug_images=False):
         """Detect if there's significant motion in the frame compared to previous
         
         Args:
             cam_id: Camera identifier
-            frame_path: Path to the current frame
+            frame: Path to the current frame, a MemoryFrame, or the already decoded BGR/grayscale frame
             debug: If True, output detailed debug information
             save_debug_images: If True, save visualization images for debugging
         """
         # Get camera-specific thresholds or use defaults
         camera_config = self.cameras[cam_id]
         motion_threshold = camera_config.get('motion_threshold', self.default_motion_threshold)
-        min_motion_area = camera_config.get('min_motion_area', self.default_min_motion_area)
         blur_kernel = camera_config.get('blur_kernel', self.default_blur_kernel)
+        three_frame_diff = camera_config.get('three_frame_diff', self.default_three_frame_diff)
         
         with self.frame_locks[cam_id]:
             try:
-                # Read current frame
-                current_frame = cv2.imread(str(frame_path), cv2.IMREAD_GRAYSCALE)
+                if isinstance(frame, np.ndarray):
+                    frame_path = None
+                    frame_name = 'in-memory frame'
+                elif isinstance(frame, MemoryFrame):
+                    frame_path = None
+                    frame_name = frame.name
+                else:
+                    frame_path = Path(frame)
+                    frame_name = frame_path.name
+                
+                current_frame, source_size = self._prepare_motion_frame(cam_id, frame)
                 
                 if current_frame is None:
                     if debug:
                         logger.info(f"[{cam_id}] Could not read frame {frame_path}, keeping it")
                     return True  # Keep frame if we can't read it
                 
-                # Apply Gaussian blur to reduce noise (if enabled)
-                if blur_kernel > 0:
-                    # Ensure kernel size is odd
-                    kernel_size = blur_kernel if blur_kernel % 2 == 1 else blur_kernel + 1
-                    current_frame = cv2.GaussianBlur(current_frame, (kernel_size, kernel_size), 0)
+                source_width, source_height = source_size
+                min_motion_area = self._scaled_min_motion_area(cam_id, source_size)
                 
                 # If no previous frame, keep this one
                 if cam_id not in self.previous_frames:
-                    self.previous_frames[cam_id] = current_frame
+                    self.previous_frames[cam_id] = self._reference_buffer(cam_id, 'prev', current_frame)
+                    self._device_prev.pop(cam_id, None)
                     if debug:
-                        logger.info(f"[{cam_id}] No previous frame, keeping {frame_path.name}")
+                        logger.info(f"[{cam_id}] No previous frame, keeping {frame_name}")
                     return True
                 
                 # Calculate difference
                 prev_frame = self.previous_frames[cam_id]
+                prev_prev_frame = self.prev_prev_frames.get(cam_id) if three_frame_diff else None
                 
-                # Resize if dimensions don't match
-                if current_frame.shape != prev_frame.shape:
-                    prev_frame = cv2.resize(prev_frame, 
-                                          (current_frame.shape[1], current_frame.shape[0]))
+                # Count with the numba or opencl backend first, frames that can't have
+                # motion then never build the difference and threshold images on the host
+                pixels_changed = None
+                self._device_current.pop(cam_id, None)
+                if not (debug or save_debug_images):
+                    pixels_changed = self._count_motion_pixels(cam_id, prev_frame, current_frame, motion_threshold)
                 
-                # Compute absolute difference
-                frame_diff = cv2.absdiff(prev_frame, current_frame)
-                
-                # Threshold the difference
-                _, thresh = cv2.threshold(frame_diff, motion_threshold, 255, cv2.THRESH_BINARY)
-                
-                # Calculate statistics for debug output
-                if debug:
+                if pixels_changed is not None and pixels_changed <= min_motion_area:
+                    has_motion = False
+                else:
+                    # Reuse the camera's buffers instead of allocating new images on every call
+                    if cam_id not in self._diff_buf or self._diff_buf[cam_id].shape != current_frame.shape:
+                        self._diff_buf[cam_id] = np.empty_like(current_frame)
+                        self._thresh_buf[cam_id] = np.empty_like(current_frame)
+                    
+                    # Compute absolute difference
+                    frame_diff = cv2.absdiff(prev_frame, current_frame, dst=self._diff_buf[cam_id])
+                    
+                    # Threshold the difference
+                    _, thresh = cv2.threshold(frame_diff, motion_threshold, 255, cv2.THRESH_BINARY, dst=self._thresh_buf[cam_id])
+                    
+                    # Three-frame differencing: only keep pixels that also changed between the two
+                    # previous frames, which rejects single-frame flicker and stream artifacts
+                    if prev_prev_frame is not None:
+                        if cam_id not in self._diff2_buf or self._diff2_buf[cam_id].shape != current_frame.shape:
+                            self._diff2_buf[cam_id] = np.empty_like(current_frame)
+                            self._thresh2_buf[cam_id] = np.empty_like(current_frame)
+                        prev_diff = cv2.absdiff(prev_prev_frame, prev_frame, dst=self._diff2_buf[cam_id])
+                        _, prev_thresh = cv2.threshold(prev_diff, motion_threshold, 255, cv2.THRESH_BINARY, dst=self._thresh2_buf[cam_id])
+                        cv2.bitwise_and(thresh, prev_thresh, dst=thresh)
+                    
+                    # Ignore changes outside the camera's motion mask
+                    if cam_id in self._motion_masks:
+                        cv2.bitwise_and(thresh, self._motion_masks[cam_id], dst=thresh)
+                    
+                    # No region can be large enough if not enough pixels changed in total
+                    pixels_changed = cv2.countNonZero(thresh)
+                    if pixels_changed <= min_motion_area:
+                        has_motion = False
+                    else:
+                        # Check if the largest connected region of changed pixels is large enough
+                        # (the opening only removes pixels, so the count above stays an upper bound)
+                        self._despeckle(cam_id, thresh)
+                        has_motion = self._largest_region_area(thresh) > min_motion_area
+                    
+                # Calculate statistics and regions for debug output only
+                if debug or save_debug_images:
                     mean_diff = np.mean(frame_diff)
                     max_diff = np.max(frame_diff)
-                    pixels_changed = np.count_nonzero(thresh)
                     total_pixels = thresh.size
                     change_percentage = (pixels_changed / total_pixels) * 100
-                
-                # Find contours
-                contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                
-                # Get contour areas for debug
-                contour_areas = [cv2.contourArea(c) for c in contours] if contours else []
-                significant_contours = [area for area in contour_areas if area > min_motion_area]
-                significant_contour_objects = [c for c in contours if cv2.contourArea(c) > min_motion_area]
-                
-                # Check if any contour is large enough
-                has_motion = len(significant_contours) > 0
+                    
+                    # Connected regions of changed pixels as (x, y, width, height, area) rows, without the background
+                    regions = cv2.connectedComponentsWithStats(thresh, connectivity=8)[2][1:]
+                    region_areas = regions[:, cv2.CC_STAT_AREA].tolist()
+                    significant_regions = regions[regions[:, cv2.CC_STAT_AREA] > min_motion_area]
                 
                 if debug:
-                    logger.info(f"[{cam_id}] Frame: {frame_path.name}")
-                    logger.info(f"  Thresholds: motion_threshold={motion_threshold}, min_motion_area={min_motion_area}, blur_kernel={blur_kernel}")
+                    logger.info(f"[{cam_id}] Frame: {frame_name}")
+                    logger.info(f"  Thresholds: motion_threshold={motion_threshold}, min_motion_area={min_motion_area:.1f} (scaled), blur_kernel={blur_kernel}")
                     logger.info(f"  Difference stats: mean={mean_diff:.2f}, max={max_diff:.2f}")
                     logger.info(f"  Changed pixels: {pixels_changed}/{total_pixels} ({change_percentage:.2f}%)")
-                    logger.info(f"  Contours found: {len(contours)}")
-                    if contour_areas:
-                        logger.info(f"  Contour areas: {sorted(contour_areas, reverse=True)[:5]}")  # Show top 5
-                    logger.info(f"  Significant contours (>{min_motion_area}): {len(significant_contours)}")
+                    logger.info(f"  Regions found: {len(regions)}")
+                    if region_areas:
+                        logger.info(f"  Region areas: {sorted(region_areas, reverse=True)[:5]}")  # Show top 5
+                    logger.info(f"  Significant regions (>{min_motion_area:.1f}): {len(significant_regions)}")
                     logger.info(f"  Decision: {'KEEP (motion detected)' if has_motion else 'DISCARD (no motion)'}")
                 
                 # Save debug visualization images
@@ -349,10 +1240,21 @@ class CCTVSummarizer:
                     debug_dir = self.output_path / 'debug' / cam_id
                     debug_dir.mkdir(parents=True, exist_ok=True)
                     
-                    base_name = frame_path.stem
+                    if frame_path is not None:
+                        base_name = frame_path.stem
+                        # Read original color frame for region overlay
+                        current_frame_color = cv2.imread(str(frame_path))
+                    elif isinstance(frame, MemoryFrame):
+                        base_name = Path(frame.name).stem
+                        current_frame_color = cv2.imdecode(np.frombuffer(frame.data, np.uint8), cv2.IMREAD_COLOR)
+                    else:
+                        base_name = datetime.now().strftime('%Y%m%d_%H%M%S')
+                        current_frame_color = frame if frame.ndim == 3 else cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
                     
-                    # Read original color frame for contour overlay
-                    current_frame_color = cv2.imread(str(frame_path))
+                    # Regions were found on the downscaled frame, map their boxes back to source pixels
+                    region_scale = np.array([source_width, source_height] * 2) / np.array(MOTION_FRAME_SIZE * 2)
+                    boxes = (regions[:, :4] * region_scale).astype(int)
+                    significant_boxes = (significant_regions[:, :4] * region_scale).astype(int)
                     
                     # 1. Save the difference image (amplified for visibility)
                     diff_amplified = cv2.normalize(frame_diff, None, 0, 255, cv2.NORM_MINMAX)
@@ -361,36 +1263,48 @@ class CCTVSummarizer:
                     # 2. Save the thresholded image
                     cv2.imwrite(str(debug_dir / f"{base_name}_2_thresh.jpg"), thresh)
                     
-                    # 3. Save image with ALL contours drawn
-                    all_contours_img = current_frame_color.copy()
-                    cv2.drawContours(all_contours_img, contours, -1, (0, 255, 0), 2)
-                    cv2.imwrite(str(debug_dir / f"{base_name}_3_all_contours.jpg"), all_contours_img)
+                    # 3. Save image with ALL regions drawn
+                    all_regions_img = current_frame_color.copy()
+                    for x, y, w, h in boxes:
+                        cv2.rectangle(all_regions_img, (x, y), (x + w, y + h), (0, 255, 0), 2)
+                    cv2.imwrite(str(debug_dir / f"{base_name}_3_all_regions.jpg"), all_regions_img)
                     
-                    # 4. Save image with SIGNIFICANT contours only
-                    sig_contours_img = current_frame_color.copy()
-                    cv2.drawContours(sig_contours_img, significant_contour_objects, -1, (0, 0, 255), 3)
+                    # 4. Save image with SIGNIFICANT regions only
+                    sig_regions_img = current_frame_color.copy()
+                    for x, y, w, h in significant_boxes:
+                        cv2.rectangle(sig_regions_img, (x, y), (x + w, y + h), (0, 0, 255), 3)
                     
                     # Add text overlay with stats
                     font = cv2.FONT_HERSHEY_SIMPLEX
                     y_offset = 30
-                    cv2.putText(sig_contours_img, f"Mean diff: {mean_diff:.2f}", (10, y_offset), font, 0.7, (255, 255, 255), 2)
+                    cv2.putText(sig_regions_img, f"Mean diff: {mean_diff:.2f}", (10, y_offset), font, 0.7, (255, 255, 255), 2)
                     y_offset += 30
-                    cv2.putText(sig_contours_img, f"Max diff: {max_diff:.2f}", (10, y_offset), font, 0.7, (255, 255, 255), 2)
+                    cv2.putText(sig_regions_img, f"Max diff: {max_diff:.2f}", (10, y_offset), font, 0.7, (255, 255, 255), 2)
                     y_offset += 30
-                    cv2.putText(sig_contours_img, f"Changed: {change_percentage:.2f}%", (10, y_offset), font, 0.7, (255, 255, 255), 2)
+                    cv2.putText(sig_regions_img, f"Changed: {change_percentage:.2f}%", (10, y_offset), font, 0.7, (255, 255, 255), 2)
                     y_offset += 30
-                    cv2.putText(sig_contours_img, f"Contours: {len(contours)} ({len(significant_contours)} sig)", (10, y_offset), font, 0.7, (255, 255, 255), 2)
+                    cv2.putText(sig_regions_img, f"Regions: {len(regions)} ({len(significant_regions)} sig)", (10, y_offset), font, 0.7, (255, 255, 255), 2)
                     y_offset += 30
-                    cv2.putText(sig_contours_img, f"Decision: {'KEEP' if has_motion else 'DISCARD'}", (10, y_offset), font, 0.7, (0, 255, 0) if has_motion else (0, 0, 255), 2)
+                    cv2.putText(sig_regions_img, f"Decision: {'KEEP' if has_motion else 'DISCARD'}", (10, y_offset), font, 0.7, (0, 255, 0) if has_motion else (0, 0, 255), 2)
                     
-                    cv2.imwrite(str(debug_dir / f"{base_name}_4_significant.jpg"), sig_contours_img)
+                    cv2.imwrite(str(debug_dir / f"{base_name}_4_significant.jpg"), sig_regions_img)
                     
                     if debug:
                         logger.info(f"  Debug images saved to: {debug_dir}")
                 
-                # Update previous frame if motion detected
-                if has_motion:
-                    self.previous_frames[cam_id] = current_frame
+                if three_frame_diff:
+                    # Differences are between consecutive frames, shift the buffers on every frame
+                    # (copied rather than swapped, so persisted buffers keep their role)
+                    if prev_prev_frame is None:
+                        self.prev_prev_frames[cam_id] = self._reference_buffer(cam_id, 'prev2', prev_frame)
+                    else:
+                        np.copyto(prev_prev_frame, prev_frame)
+                    np.copyto(prev_frame, current_frame)
+                    self._update_device_reference(cam_id)
+                elif has_motion:
+                    # Update previous frame in place if motion detected
+                    np.copyto(prev_frame, current_frame)
+                    self._update_device_reference(cam_id)
                 
                 return has_motion
                 
@@ -398,23 +1312,74 @@ class CCTVSummarizer:
                 logger.error(f"Error in motion detection for {cam_id}: {e}")
                 return True  # Keep frame on error
     
+    def _indexed_frames(self, cam_id):
+        """Frame index of a camera, scanned from its frames directory on first use
+        
+        Must be called with _frame_index_lock held.
+        """
+        index = self._frame_index.get(cam_id)
+        if index is None:
+            # Filenames are fixed-width timestamps (e.g., '20231115_143022.jpg'), so they
+            # sort in time order as plain strings - no need to parse each of them
+            with os.scandir(self._frames_dirs[cam_id]) as entries:
+                index = deque(sorted((entry.name, os.path.abspath(entry.path))
+                                     for entry in entries if entry.name.endswith('.jpg')))
+            self._frame_index[cam_id] = index
+        return index
+    
+    def _add_to_frame_index(self, cam_id, filename, path):
+        """Record a newly written frame in the camera's frame index"""
+        entry = (filename, os.path.abspath(path))
+        with self._frame_index_lock:
+            index = self._indexed_frames(cam_id)
+            if not index or filename > index[-1][0]:
+                index.append(entry)
+            else:
+                # Clock went back, or the file replaced a frame of the same second
+                position = bisect.bisect_left(index, entry)
+                if position == len(index) or index[position][0] != filename:
+                    index.insert(position, entry)
+    
+    def _stored_memory_frames(self, cam_id):
+        """Return the camera's ring of in-memory frames, oldest first (the frame index lock must be held)"""
+        if cam_id not in self._memory_frames:
+            self._memory_frames[cam_id] = deque(maxlen=self._memory_frames_max)
+        return self._memory_frames[cam_id]
+    
+    @staticmethod
+    def _frame_exists(frame):
+        """Check a frame is still available; in-memory frames are, as long as they're referenced"""
+        return isinstance(frame, MemoryFrame) or frame.exists()
+    
     def cleanup_old_frames(self, cam_id):
         """Remove frames older than summary_duration"""
         cutoff_time = datetime.now() - timedelta(seconds=self.summary_duration)
-        frames_dir = self.frames_path / cam_id
+        cutoff_name = cutoff_time.strftime('%Y%m%d_%H%M%S.jpg')
+        
+        if self.frame_storage == 'memory':
+            # The ring's size already bounds it, this drops frames left over from a capture gap
+            with self._frame_index_lock:
+                frames = self._stored_memory_frames(cam_id)
+                while frames and frames[0].name < cutoff_name:
+                    frames.popleft()
+            return
+        
+        # Expired frames are at the start of the sorted index
+        expired = []
+        with self._frame_index_lock:
+            index = self._indexed_frames(cam_id)
+            while index and index[0][0] < cutoff_name:
+                expired.append(index.popleft()[1])
         
         deleted_count = 0
-        for frame_file in frames_dir.glob('*.jpg'):
+        for path in expired:
             try:
-                # Parse timestamp from filename
-                timestamp_str = frame_file.stem  # e.g., '20231115_143022'
-                frame_time = datetime.strptime(timestamp_str, '%Y%m%d_%H%M%S')
-                
-                if frame_time < cutoff_time:
-                    frame_file.unlink()
-                    deleted_count += 1
+                os.unlink(path)
+                deleted_count += 1
+            except FileNotFoundError:
+                pass
             except Exception as e:
-                logger.debug(f"Error processing {frame_file}: {e}")
+                logger.debug(f"Error processing {path}: {e}")
         
         if deleted_count > 0:
             logger.info(f"Cleaned up {deleted_count} old frames from {cam_id}")
@@ -422,33 +1387,32 @@ class CCTVSummarizer:
     def generate_video(self, cam_id):
         """Generate a video from captured frames for a camera"""
         camera_config = self.cameras[cam_id]
-        frames_dir = self.frames_path / cam_id
-        all_frames = sorted(frames_dir.glob('*.jpg'))
+        frames_dir = self._frames_dirs[cam_id]
+        
+        # Frames in capture order, from the in-memory index instead of listing the directory
+        with self._frame_index_lock:
+            if self.frame_storage == 'memory':
+                all_frames = list(self._stored_memory_frames(cam_id))
+            else:
+                all_frames = [Path(path) for _, path in self._indexed_frames(cam_id)]
         
         if len(all_frames) < 2:
             logger.info(f"Not enough frames to generate video for {cam_id}")
             return
         
-        # Apply motion detection filter if enabled
-        if camera_config.get('track_changes', False):
+        # Apply motion detection filter if enabled (frames filtered on capture are already filtered)
+        filter_frames = self._tracks_changes(cam_id) and not self._filters_on_capture(cam_id)
+        if filter_frames:
             logger.info(f"Filtering frames for {cam_id} using motion detection...")
-            # Reset previous frame for motion detection
-            if cam_id in self.previous_frames:
-                del self.previous_frames[cam_id]
             
-            frames = []
-            discarded_count = 0
-            for frame_path in all_frames:
-                # Check if frame still exists (might have been cleaned up)
-                if not frame_path.exists():
-                    logger.debug(f"Frame {frame_path.name} no longer exists, skipping")
-                    discarded_count += 1
-                    continue
-                    
-                if self._has_motion(cam_id, frame_path, debug=False, save_debug_images=False):
-                    frames.append(frame_path)
-                else:
-                    discarded_count += 1
+            if camera_config.get('three_frame_diff', self.default_three_frame_diff):
+                # Three-frame references rotate on every frame, check frames one by one
+                self._reset_motion_state(cam_id)
+                frames = [frame_path for frame_path in all_frames
+                          if self._frame_exists(frame_path) and self._has_motion(cam_id, frame_path)]
+            else:
+                frames = self._filter_motion_frames(cam_id, all_frames)
+            discarded_count = len(all_frames) - len(frames)
             
             logger.info(f"Motion detection: kept {len(frames)}/{len(all_frames)} frames, discarded {discarded_count}")
             
@@ -458,7 +1422,7 @@ class CCTVSummarizer:
         else:
             frames = all_frames
             # Filter out non-existent frames even when motion detection is disabled
-            existing_frames = [f for f in frames if f.exists()]
+            existing_frames = [f for f in frames if self._frame_exists(f)]
             missing_count = len(frames) - len(existing_frames)
             if missing_count > 0:
                 logger.warning(f"{missing_count} frames no longer exist for {cam_id}, excluding from video")
@@ -470,58 +1434,59 @@ class CCTVSummarizer:
         
         # Generate video filename with current timestamp
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        video_format = self.settings.get('video_format', 'mp4')
-        output_video = self.videos_path / cam_id / f"{timestamp}.{video_format}"
+        output_video = self._videos_dirs[cam_id] / f"{timestamp}.{self.video_format}"
         
-        # Create input file list for ffmpeg
-        input_list = self.frames_path / cam_id / f"input_list_{timestamp}.txt"
+        # Data for ffmpeg's stdin: the concat list when motion detection picked a subset of frames,
+        # or the JPEGs themselves for in-memory frames
+        stdin_chunks = []
         
         try:
-            with open(input_list, 'w') as f:
+            if self.frame_storage == 'memory':
+                # JPEGs go to ffmpeg back to back, frame by frame, without touching the disk
+                stdin_chunks = [frame.data for frame in frames]
+                input_args = ['-f', 'image2pipe', '-c:v', 'mjpeg', '-framerate', str(self.video_fps), '-i', 'pipe:0']
+            elif filter_frames:
+                listed = []
                 for frame in frames:
                     # Verify frame exists before adding to list
                     if not frame.exists():
                         logger.warning(f"Frame {frame.name} disappeared before video generation, skipping")
                         continue
-                    # Write absolute path to each frame
-                    f.write(f"file '{frame.absolute()}'\n")
-                # ffmpeg concat demuxer will display each frame for equal time
-            
-            # Check if we still have enough frames after verification
-            # Re-read the file to count valid entries
-            with open(input_list, 'r') as f:
-                valid_frame_count = len([line for line in f if line.strip().startswith('file')])
-            
-            if valid_frame_count < 2:
-                logger.warning(f"Not enough valid frames remaining for {cam_id} after verification ({valid_frame_count})")
-                return
-            
-            # Get FPS from config (default: 25)
-            video_fps = self.settings.get('video_fps', 25)
+                    listed.append(frame)
+                
+                # Check if we still have enough frames after verification
+                if len(listed) < 2:
+                    logger.warning(f"Not enough valid frames remaining for {cam_id} after verification ({len(listed)})")
+                    return
+                
+                # Frame index paths are absolute already, so the whole list is a single join;
+                # -r on the input replaces the concat timestamps (1/25 s per image) with one frame per
+                # image at video_fps, the same as the -framerate of the glob input. The list is piped
+                # to ffmpeg instead of going through a temporary file. concat resolves entries
+                # against the list's URL (pipe:), so each one names the file: protocol explicitly,
+                # which the whitelist allows
+                stdin_chunks = [''.join([f"file 'file:{frame}'\n" for frame in listed]).encode()]
+                input_args = ['-r', str(self.video_fps), '-f', 'concat', '-safe', '0',
+                              '-protocol_whitelist', 'file,pipe', '-i', 'pipe:0']
+            else:
+                # All frames are used, let ffmpeg read them directly in (timestamp) name order
+                frames_glob = os.path.join(glob.escape(str(frames_dir.absolute())), '*.jpg')
+                input_args = ['-framerate', str(self.video_fps), '-pattern_type', 'glob', '-i', frames_glob]
             
             # Use ffmpeg to create video
-            cmd = [
-                'ffmpeg',
-                '-y',
-                '-f', 'concat',
-                '-safe', '0',
-                '-i', str(input_list.absolute()),
-                '-vf', f"scale=-2:{self.settings.get('resolution', '720p').rstrip('p')}",
-                '-r', str(video_fps),  # Set output frame rate
-                '-c:v', 'libx264',
-                '-preset', 'medium',
-                '-crf', '23',
-                '-pix_fmt', 'yuv420p',
-                str(output_video.absolute())
-            ]
-            
-            logger.info(f"Generating video for {cam_id}...")
-            result = subprocess.run(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                timeout=300
-            )
+            encoder = self._get_video_encoder()
+            logger.info(f"Generating video for {cam_id} using {encoder}...")
+            result = self._run_encoder(self._video_encode_cmd(input_args, output_video, encoder), stdin_chunks)
+            
+            # A listed hardware encoder may still be unusable (no device, driver mismatch)
+            if result.returncode != 0 and encoder != 'libx264':
+                logger.warning(f"{encoder} failed for {cam_id}, retrying with libx264: {result.stderr.decode()}")
+                result = self._run_encoder(self._video_encode_cmd(input_args, output_video, 'libx264'), stdin_chunks)
+                # Only blame the hardware encoder when the same input encodes fine in software,
+                # a bad input fails both and shouldn't switch every camera to libx264
+                if result.returncode == 0:
+                    logger.warning(f"Using libx264 instead of {encoder} from now on")
+                    self._video_encoder = 'libx264'
             
             if result.returncode == 0 and output_video.exists():
                 logger.info(f"Video generated: {output_video}")
@@ -533,13 +1498,15 @@ class CCTVSummarizer:
                 
                 # Create/update symlink to latest video (optional, disabled by default)
                 if self.create_latest_link:
-                    latest_video = self.videos_path / cam_id / f"latest.{video_format}"
+                    latest_video = self._videos_dirs[cam_id] / f"latest.{self.video_format}"
                     try:
-                        # Remove old symlink/file if it exists
-                        if latest_video.exists() or latest_video.is_symlink():
-                            latest_video.unlink()
-                        # Create symlink to the new video
-                        latest_video.symlink_to(output_video.name)
+                        # Create the new symlink next to the old one and rename it over it, so
+                        # readers always find either the old or the new link, never none
+                        temp_link = latest_video.with_name(f".{latest_video.name}.tmp")
+                        if temp_link.is_symlink():
+                            temp_link.unlink()  # Left over from an interrupted update
+                        os.symlink(output_video.name, temp_link)
+                        os.replace(temp_link, latest_video)
                         logger.debug(f"Updated latest video link for {cam_id}")
                     except Exception as e:
                         logger.warning(f"Failed to create latest video link for {cam_id}: {e}")
@@ -551,13 +1518,104 @@ class CCTVSummarizer:
             
         except Exception as e:
             logger.error(f"Error generating video for {cam_id}: {e}")
-        finally:
-            # Cleanup input list file (keep it if there was an error for debugging)
-            if input_list.exists():
+    
+    @staticmethod
+    def _run_encoder(cmd, stdin_chunks, timeout=300):
+        """Run an ffmpeg encode, writing stdin_chunks to its stdin one by one
+        
+        Chunks are streamed rather than joined, so in-memory frames aren't copied into one
+        large buffer. They're written from a helper thread, so the timeout bounds the whole encode
+        even when ffmpeg stops reading; on timeout ffmpeg is killed, which also ends the writes.
+        stderr goes to a temporary file, so it can't fill up while stdin is written, and is only
+        read back into memory when the encode fails.
+        
+        Returns:
+            subprocess.CompletedProcess with the return code and stderr
+        """
+        def feed_stdin(stdin):
+            try:
+                for chunk in stdin_chunks:
+                    stdin.write(chunk)
+            except OSError:
+                pass  # ffmpeg exited or was killed, its return code says what happened
+            finally:
                 try:
-                    input_list.unlink()
-                except Exception as e:
-                    logger.debug(f"Could not delete input list file: {e}")
+                    stdin.close()
+                except OSError:
+                    pass
+        
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr_file)
+            feeder = Thread(target=feed_stdin, args=(process.stdin,), name='encoder-stdin', daemon=True)
+            feeder.start()
+            try:
+                returncode = process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+                raise
+            finally:
+                # The writes end once ffmpeg is gone; don't wait forever on a child that still holds the pipe
+                feeder.join(timeout=10)
+            stderr = b''
+            if returncode != 0:
+                stderr_file.seek(0)
+                stderr = stderr_file.read()
+            return subprocess.CompletedProcess(cmd, returncode, stderr=stderr)
+    
+    def _get_video_encoder(self):
+        """Resolve the configured video encoder, probing ffmpeg once when set to 'auto'"""
+        if self._video_encoder is not None:
+            return self._video_encoder
+        
+        if self.hw_encoder in VIDEO_ENCODERS:
+            self._video_encoder = self.hw_encoder
+            return self._video_encoder
+        
+        if self.hw_encoder not in ('auto', 'none'):
+            logger.warning(f"Unknown hw_encoder '{self.hw_encoder}', using auto detection")
+        
+        self._video_encoder = 'libx264'
+        if self.hw_encoder != 'none':
+            try:
+                result = subprocess.run(
+                    ['ffmpeg', '-hide_banner', '-encoders'],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    timeout=10
+                )
+                available = {line.split()[1] for line in result.stdout.decode().splitlines() if len(line.split()) > 1}
+                for encoder in VIDEO_ENCODERS:
+                    if encoder in available:
+                        self._video_encoder = encoder
+                        break
+            except Exception as e:
+                logger.warning(f"Failed to probe ffmpeg encoders: {e}")
+        
+        logger.info(f"Using video encoder: {self._video_encoder}")
+        return self._video_encoder
+    
+    def _video_encode_cmd(self, input_args, output_video, encoder):
+        """Build the ffmpeg command encoding the given input into output_video"""
+        if encoder not in self._encode_cmd_parts:
+            encoder_args = VIDEO_ENCODERS[encoder]
+            self._encode_cmd_parts[encoder] = (
+                [
+                    'ffmpeg',
+                    '-y',
+                    '-loglevel', 'error',  # No banner or progress lines, stderr is only kept for errors
+                    '-nostats',
+                    *encoder_args['global'],
+                ],
+                [
+                    '-vf', f"scale=-2:{self._video_scale}{encoder_args['filter']}",
+                    '-r', str(self.video_fps),  # Set output frame rate
+                    *encoder_args['output'],
+                ],
+            )
+        
+        before_input, after_input = self._encode_cmd_parts[encoder]
+        return [*before_input, *input_args, *after_input, str(output_video.absolute())]
     
     def _generate_iframe_html(self, cam_id, video_path):
         """Generate an HTML file with iframe pointing to the video"""
@@ -566,9 +1624,7 @@ class CCTVSummarizer:
             # Format: cam_id/timestamp.mp4
             relative_video_path = f"{cam_id}/{video_path.name}"
             
-            # Replace placeholders in template (support both formats)
-            html_content = self.iframe_template.replace('{{video_path}}', relative_video_path)
-            html_content = html_content.replace('$RELPATH', relative_video_path)
+            html_content = self.iframe_template_str.format_map({'video_path': relative_video_path})
             
             # Write HTML file in videos directory with camera id as filename
             html_file = self.videos_path / f"{cam_id}.html"
@@ -579,6 +1635,14 @@ class CCTVSummarizer:
         except Exception as e:
             logger.error(f"Failed to generate iframe HTML for {cam_id}: {e}")
     
+    @staticmethod
+    def _parse_timestamp(name):
+        """Parse the YYYYMMDD_HHMMSS prefix of a frame or video filename by slicing, without strptime"""
+        if len(name) < 15 or name[8] != '_':
+            raise ValueError(f"Not a timestamp filename: {name}")
+        return datetime(int(name[0:4]), int(name[4:6]), int(name[6:8]),
+                        int(name[9:11]), int(name[11:13]), int(name[13:15]))
+    
     def _generate_history_html(self, cam_id):
         """Generate a history HTML file showing all previous day videos for a camera"""
         try:
@@ -586,49 +1650,41 @@ class CCTVSummarizer:
                 logger.debug(f"Templates not configured, skipping history HTML for {cam_id}")
                 return
             
-            videos_dir = self.videos_path / cam_id
+            videos_dir = self._videos_dirs[cam_id]
             
-            # Get all video files and parse their dates
-            video_files = []
-            for video_file in videos_dir.glob('*.mp4'):
-                # Skip the 'latest.mp4' symlink
-                if video_file.name.startswith('latest.'):
-                    continue
-                    
-                try:
-                    timestamp_str = video_file.stem
-                    video_time = datetime.strptime(timestamp_str, '%Y%m%d_%H%M%S')
-                    video_files.append((video_file, video_time))
-                except Exception as e:
-                    logger.debug(f"Error processing {video_file}: {e}")
+            # Group videos by date and keep only one per day (the newest); filenames are
+            # fixed-width timestamps, so name[:8] is the date key and names sort in time order
+            videos_by_date = {}
+            with os.scandir(videos_dir) as entries:
+                for entry in entries:
+                    # Skip the 'latest.mp4' symlink and anything not named by timestamp
+                    if not entry.name.endswith('.mp4') or not entry.name[:8].isdigit():
+                        continue
+                    date_key = entry.name[:8]
+                    if entry.name > videos_by_date.get(date_key, ''):
+                        videos_by_date[date_key] = entry.name
             
-            if not video_files:
+            if not videos_by_date:
                 logger.debug(f"No video files found for {cam_id} history")
                 return
             
-            # Sort by timestamp (newest first)
-            video_files.sort(key=lambda x: x[1], reverse=True)
-            
-            # Group videos by date and keep only one per day (the newest)
-            videos_by_date = {}
-            for video_file, video_time in video_files:
-                date_key = video_time.date()
-                if date_key not in videos_by_date:
-                    videos_by_date[date_key] = (video_file, video_time)
-            
             # Generate video sections HTML
             video_sections = []
             for date_key in sorted(videos_by_date.keys(), reverse=True):
-                video_file, video_time = videos_by_date[date_key]
-                relative_video_path = f"{cam_id}/{video_file.name}"
+                video_name = videos_by_date[date_key]
+                relative_video_path = f"{cam_id}/{video_name}"
                 
-                # Format date nicely
+                # Only the kept video per day is parsed, to format its date nicely
+                try:
+                    video_time = self._parse_timestamp(video_name)
+                except ValueError as e:
+                    logger.debug(f"Error processing {video_name}: {e}")
+                    continue
                 date_str = video_time.strftime('%A, %B %d, %Y')
                 time_str = video_time.strftime('%I:%M %p')
                 
                 # Generate video player from iframe template
-                video_player = self.iframe_template.replace('{{video_path}}', relative_video_path)
-                video_player = video_player.replace('$RELPATH', relative_video_path)
+                video_player = self.iframe_template_str.format_map({'video_path': relative_video_path})
                 
                 # Build video section
                 section = f'''<div class="video-container">
@@ -655,84 +1711,93 @@ class CCTVSummarizer:
     
     def _cleanup_old_videos(self, cam_id):
         """Remove old video files to save space (keep one video per previous day)"""
-        videos_dir = self.videos_path / cam_id
+        videos_dir = self._videos_dirs[cam_id]
         
-        # Get all video files and parse their dates
-        video_files = []
-        for video_file in videos_dir.glob('*.mp4'):
-            # Skip the 'latest.mp4' symlink
-            if video_file.name.startswith('latest.'):
-                continue
-                
-            try:
-                timestamp_str = video_file.stem
-                video_time = datetime.strptime(timestamp_str, '%Y%m%d_%H%M%S')
-                video_files.append((video_file, video_time))
-            except Exception as e:
-                logger.debug(f"Error processing {video_file}: {e}")
+        # Group videos by date; filenames start with YYYYMMDD, which is the date key as is
+        videos_by_date = {}
+        with os.scandir(videos_dir) as entries:
+            for entry in entries:
+                # Skip the 'latest.mp4' symlink and anything not named by timestamp
+                if not entry.name.endswith('.mp4') or not entry.name[:8].isdigit():
+                    continue
+                videos_by_date.setdefault(entry.name[:8], []).append(entry.path)
         
-        if not video_files:
+        if not videos_by_date:
             return
         
-        # Sort by timestamp (newest first)
-        video_files.sort(key=lambda x: x[1], reverse=True)
-        
-        # Group videos by date
-        videos_by_date = {}
-        for video_file, video_time in video_files:
-            date_key = video_time.date()
-            if date_key not in videos_by_date:
-                videos_by_date[date_key] = []
-            videos_by_date[date_key].append(video_file)
-        
         # For each day, keep only the newest video and delete the rest
         deleted_count = 0
         for date_key in sorted(videos_by_date.keys()):
             daily_videos = videos_by_date[date_key]
-            # Keep the first (newest) video, delete the rest
+            # Keep the newest video (last in name order), delete the rest
+            daily_videos.sort(reverse=True)
             for video_file in daily_videos[1:]:
                 try:
-                    video_file.unlink()
+                    os.unlink(video_file)
                     deleted_count += 1
-                    logger.debug(f"Deleted older same-day video: {video_file.name}")
+                    logger.debug(f"Deleted older same-day video: {os.path.basename(video_file)}")
                 except Exception as e:
                     logger.error(f"Error deleting {video_file}: {e}")
         
         if deleted_count > 0:
             logger.info(f"Cleaned up {deleted_count} old same-day videos from {cam_id}")
     
+    def _capture_and_cleanup(self, cam_id, camera_config, run_cleanup):
+        """Capture a frame and optionally clean up old frames of one camera (runs in the capture pool)"""
+        try:
+            self.capture_frame(cam_id, camera_config)
+            
+            if run_cleanup:
+                self.cleanup_old_frames(cam_id)
+        except Exception as e:
+            logger.error(f"Error capturing from {cam_id}: {e}")
+    
     def capture_loop(self):
         """Main loop for capturing frames"""
         logger.info("Starting capture loop...")
+        self._load_motion_state()
+        self._start_writer()
         last_video_generation = {cam_id: time.time() for cam_id in self.cameras.keys()}
         last_cleanup = {cam_id: time.time() for cam_id in self.cameras.keys()}
         # Run cleanup less frequently to avoid race conditions with video generation
         # Cleanup every 10 minutes instead of every capture interval
         cleanup_interval = 600  # 10 minutes in seconds
+        captures = {}  # Pending capture per camera
+        videos = {}  # Pending video generation per camera
         
         while True:
             try:
                 current_time = time.time()
                 
-                # Capture frames from all cameras
+                # Capture frames from all cameras in parallel
                 for cam_id, camera_config in self.cameras.items():
-                    self.capture_frame(cam_id, camera_config)
-                    
-                    # Only cleanup frames periodically, not on every capture
-                    if current_time - last_cleanup[cam_id] >= cleanup_interval:
-                        self.cleanup_old_frames(cam_id)
-                        last_cleanup[cam_id] = current_time
+                    if cam_id in captures and not captures[cam_id].done():
+                        logger.warning(f"Previous capture for {cam_id} still running, skipping this interval")
+                    else:
+                        # Only cleanup frames periodically, not on every capture
+                        run_cleanup = current_time - last_cleanup[cam_id] >= cleanup_interval
+                        if run_cleanup:
+                            last_cleanup[cam_id] = current_time
+                        captures[cam_id] = self._pool.submit(self._capture_and_cleanup, cam_id, camera_config, run_cleanup)
                     
                     # Check if it's time to generate video
                     if current_time - last_video_generation[cam_id] >= self.video_generation_interval:
-                        Thread(target=self.generate_video, args=(cam_id,)).start()
+                        if cam_id in videos and not videos[cam_id].done():
+                            logger.warning(f"Previous video generation for {cam_id} still running, skipping this interval")
+                        else:
+                            videos[cam_id] = self._video_pool.submit(self.generate_video, cam_id)
                         last_video_generation[cam_id] = current_time
                 
-                # Wait for next capture interval
-                time.sleep(self.capture_interval)
+                # Wait for next capture interval; captures, motion checks and writes run in their
+                # own threads, so the interval is kept from tick to tick instead of added to them
+                time.sleep(max(0, current_time + self.capture_interval - time.time()))
                 
             except KeyboardInterrupt:
                 logger.info("Stopping capture loop...")
+                self._pool.shutdown(wait=False)
+                self._video_pool.shutdown(wait=False)
+                self._stop_writer()
+                self.stop_readers()
                 break
             except Exception as e:
                 logger.error(f"Error in capture loop: {e}")
@@ -757,13 +1822,15 @@ class CCTVSummarizer:
                 continue
             
             camera_config = self.cameras[camera_id]
-            frames_dir = self.frames_path / camera_id
+            frames_dir = self._frames_dirs[camera_id]
             
             if not frames_dir.exists():
                 logger.warning(f"No frames directory found for {camera_id}")
                 continue
             
-            frames = sorted(frames_dir.glob('*.jpg'))
+            # Same scandir-based, name-sorted listing video generation uses
+            with self._frame_index_lock:
+                frames = [Path(path) for _, path in self._indexed_frames(camera_id)]
             
             if len(frames) < 2:
                 logger.warning(f"Not enough frames to test for {camera_id} (found {len(frames)})")
@@ -785,8 +1852,7 @@ class CCTVSummarizer:
             logger.info(f"{'='*60}\n")
             
             # Reset previous frame for this camera
-            if camera_id in self.previous_frames:
-                del self.previous_frames[camera_id]
+            self._reset_motion_state(camera_id)
             
             kept_count = 0
             discarded_count = 0
@@ -859,6 +1925,7 @@ def main():
             camera_config = summarizer.cameras[args.test_capture]
             logger.info(f"Testing capture from {args.test_capture}...")
             result = summarizer.capture_frame(args.test_capture, camera_config)
+            summarizer.stop_readers()
             if result:
                 logger.info(f"Success! Frame saved to: {result}")
             else:
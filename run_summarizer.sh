@@ -9,5 +9,21 @@ if [ -d "venv" ]; then
     source venv/bin/activate
 fi
 
+# Preload mimalloc if it's installed, so OpenCV's many small allocations (JPEG decode,
+# resize, connected components) don't go through glibc malloc. Set MIMALLOC_LIB to use
+# another library path, or to an empty string to disable it
+if [ -z "${MIMALLOC_LIB+set}" ]; then
+    for lib in /usr/lib/x86_64-linux-gnu/libmimalloc.so.2 /usr/lib/aarch64-linux-gnu/libmimalloc.so.2 \
+               /usr/lib/libmimalloc.so.2 /usr/local/lib/libmimalloc.so.2 /usr/local/lib/libmimalloc.so; do
+        if [ -f "$lib" ]; then
+            MIMALLOC_LIB="$lib"
+            break
+        fi
+    done
+fi
+if [ -n "$MIMALLOC_LIB" ] && [ "$(uname)" = "Linux" ]; then
+    export LD_PRELOAD="$MIMALLOC_LIB${LD_PRELOAD:+:$LD_PRELOAD}"
+fi
+
 # Run the summarizer
-python3 cctv_summarizer.py "$@"
+exec python3 cctv_summarizer.py "$@"